@@ -1,24 +1,30 @@
 #!/usr/bin/env python3
 # Step by step: Download PubMed data and run BioBERT NER for ocular diseases
 # Install once:
-#   pip install biopython transformers torch requests pandas tqdm
+#   pip install biopython transformers torch requests pandas tqdm pyahocorasick
 
 # ---------------------------
 # Step 0. Imports and config
 # ---------------------------
 import os
 import re
+import csv
 import json
-import time
-from typing import List, Dict, Any
-from collections import defaultdict
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Any, Optional, Iterator, TextIO, Tuple, NamedTuple
+from bisect import bisect_left
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from Bio import Entrez, Medline         # PubMed E-utilities
 import pandas as pd                     # Save tables
 from tqdm import tqdm                   # Progress bars
+import ahocorasick                      # Multi pattern keyword search
 
 import torch
-from transformers import AutoTokenizer, AutoModelForTokenClassification, TokenClassificationPipeline
+from transformers import AutoTokenizer, AutoModelForTokenClassification
 
 # User editable configuration
 ENTREZ_EMAIL = os.getenv("ENTREZ_EMAIL", "you@example.com")   # Set your email
@@ -32,14 +38,41 @@ PUBMED_QUERY = os.getenv(
 
 RETMAX = int(os.getenv("RETMAX", "300"))            # How many PubMed records to fetch
 EFETCH_BATCH = int(os.getenv("EFETCH_BATCH", "100"))# Batch size for efetch
+MEDLINE_PARSER = os.getenv("MEDLINE_PARSER", "minimal")  # minimal or biopython
 INFER_CHARS = int(os.getenv("INFER_CHARS", "4000")) # Max characters per NER chunk
+NER_BATCH = int(os.getenv("NER_BATCH", "16"))       # Token windows per NER forward pass
+SORT_BUCKET = int(os.getenv("SORT_BUCKET", "64"))   # Chunks sorted by length together
+NER_MAX_TOKENS = int(os.getenv("NER_MAX_TOKENS", "512"))  # Tokens per model window
+NER_STRIDE = int(os.getenv("NER_STRIDE", "64"))     # Overlap between windows of one chunk
+NER_COMPILE = os.getenv("NER_COMPILE", "1") == "1"  # torch.compile the model on GPU
+
+# Padded window lengths used with a compiled model, so few shapes get compiled
+LENGTH_BUCKETS = [b for b in (64, 128, 256, 384) if b < NER_MAX_TOKENS] + [NER_MAX_TOKENS]
 
 # Choose a BioBERT NER checkpoint. Replace with your fine tuned model path for best results
 NER_MODEL = os.getenv("NER_MODEL", "kamalkraj/BioBERT-NER")
+NER_FP16 = os.getenv("NER_FP16", "1") == "1"        # Half precision weights on GPU
+NER_BACKEND = os.getenv("NER_BACKEND", "torch")     # torch or onnx
+ORT_PROVIDER = os.getenv("ORT_PROVIDER")            # ONNX Runtime execution provider
 
 # Output directory
 OUT_DIR = os.getenv("OUT_DIR", "biobert_pubmed_outputs")
-os.makedirs(OUT_DIR, exist_ok=True)
+
+# Parsed MEDLINE records are cached here, one JSON file per PMID.
+# Each parser has its own folder since they keep different fields
+MEDLINE_CACHE_DIR = os.path.join(OUT_DIR, "medline_cache", MEDLINE_PARSER)
+
+# NER results per text chunk are cached here, keyed by chunk hash and by
+# every setting that can change the entities the model returns
+NER_CACHE_PATH = os.path.join(OUT_DIR, "ner_cache.sqlite")
+NER_CACHE_TAG = "|".join([
+    NER_MODEL,
+    NER_BACKEND,
+    ORT_PROVIDER or "",
+    f"fp16={NER_FP16}",
+    f"tokens={NER_MAX_TOKENS}",
+    f"stride={NER_STRIDE}"
+])
 
 
 # --------------------------------------
@@ -61,70 +94,211 @@ def search_pmids(query: str, retmax: int) -> List[str]:
 # ------------------------------------------------------
 # Step 2. Fetch MEDLINE records for a list of PubMed IDs
 # ------------------------------------------------------
+class RateLimiter:
+    """
+    Lets at most rate calls through per second, across threads.
+    Each call takes a token that a timer hands back one second later.
+    """
+    def __init__(self, rate: int):
+        self.tokens = threading.Semaphore(rate)
+
+    def acquire(self) -> None:
+        self.tokens.acquire()
+        timer = threading.Timer(1.0, self.tokens.release)
+        timer.daemon = True
+        timer.start()
+
+
+MEDLINE_KEYS = {"PMID", "TI", "AB", "JT", "TA", "DP"}
+
+def parse_medline_minimal(handle: TextIO) -> Iterator[Dict[str, str]]:
+    """
+    Streams MEDLINE text and yields records with only the fields we use.
+    Continuation lines are joined with spaces like Medline.parse does.
+    """
+    record = {}
+    key = None
+    for line in handle:
+        if line[:6] == "      ":
+            # A blank continuation line is a paragraph break, not the record end
+            value = line[6:].rstrip() or "\n"
+            if key in record:
+                record[key] += " " + value
+        elif line.strip():
+            line = line.rstrip()
+            key = line[:4].rstrip()
+            if key in MEDLINE_KEYS:
+                record[key] = record[key] + " " + line[6:] if key in record else line[6:]
+        elif line in ("\n", "\r\n") and record:
+            yield record
+            record = {}
+            key = None
+    if record:
+        yield record
+
+
+def fetch_medline_batch(pmids: List[str], limiter: RateLimiter) -> List[Dict[str, Any]]:
+    """
+    Fetches and parses one efetch batch of MEDLINE records.
+    """
+    limiter.acquire()
+    handle = Entrez.efetch(db="pubmed", id=",".join(pmids), rettype="medline", retmode="text")
+    if MEDLINE_PARSER == "biopython":
+        recs = list(Medline.parse(handle))
+    else:
+        recs = list(parse_medline_minimal(handle))
+    handle.close()
+    return recs
+
+
+def write_json_atomic(path: str, obj: Any) -> None:
+    """
+    Writes JSON to a temp file next to path, then moves it into place,
+    so an interrupted run never leaves a truncated file behind.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
 def fetch_medline_records(pmids: List[str], batch: int) -> List[Dict[str, Any]]:
     """
     Fetches MEDLINE format for PMIDs in batches. Returns a list of parsed records.
+    Records already in the disk cache are read locally. The rest are fetched
+    in parallel threads within the NCBI request rate limit and cached as
+    each batch completes. Records come back in pmids order.
     """
     Entrez.email = ENTREZ_EMAIL
     if ENTREZ_API_KEY:
         Entrez.api_key = ENTREZ_API_KEY
 
-    all_recs = []
-    for i in tqdm(range(0, len(pmids), batch), desc="Fetching MEDLINE"):
-        chunk = pmids[i:i + batch]
-        handle = Entrez.efetch(db="pubmed", id=",".join(chunk), rettype="medline", retmode="text")
-        recs = list(Medline.parse(handle))
-        handle.close()
-        all_recs.extend(recs)
-        time.sleep(0.34)   # Be polite to NCBI servers
-    return all_recs
+    os.makedirs(MEDLINE_CACHE_DIR, exist_ok=True)
+    by_pmid = {}
+    missing = []
+    for pmid in pmids:
+        path = os.path.join(MEDLINE_CACHE_DIR, f"{pmid}.json")
+        try:
+            with open(path, encoding="utf8") as f:
+                by_pmid[pmid] = json.load(f)
+        except (OSError, ValueError):
+            # Not cached yet, or a broken file from an interrupted run
+            missing.append(pmid)
+    print(f"{len(by_pmid)} records cached, fetching {len(missing)}")
+
+    # Be polite to NCBI servers: 3 requests per second, 10 with an API key
+    rate = 10 if ENTREZ_API_KEY else 3
+    limiter = RateLimiter(rate)
+
+    chunks = [missing[i:i + batch] for i in range(0, len(missing), batch)]
+    with ThreadPoolExecutor(max_workers=rate) as pool:
+        futures = [pool.submit(fetch_medline_batch, ch, limiter) for ch in chunks]
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Fetching MEDLINE"):
+            # Cache each batch as it arrives, so a failed batch loses only itself
+            for rec in fut.result():
+                pmid = rec.get("PMID", "")
+                if not pmid:
+                    continue
+                by_pmid[pmid] = rec
+                write_json_atomic(os.path.join(MEDLINE_CACHE_DIR, f"{pmid}.json"), rec)
+
+    return [by_pmid[pmid] for pmid in pmids if pmid in by_pmid]
 
 
 # ------------------------------------------------------
 # Step 3. Build text to send into the NER model
 # ------------------------------------------------------
-def join_abstract(record: Dict[str, Any]) -> str:
+def records_frame(records: List[Dict[str, Any]]) -> pd.DataFrame:
     """
-    Returns the abstract string. Handles list or string formats.
+    Builds a table of the metadata and NER input of all records at once.
+    The context column is the title and abstract joined by ". ".
     """
-    ab = record.get("AB", "")
-    if isinstance(ab, list):
-        return " ".join(ab)
-    return ab or ""
+    df = pd.DataFrame(records).reindex(columns=["PMID", "TI", "AB", "JT", "TA", "DP"]).astype(object)
+    df = df.where(df.notna(), "")
 
+    out = pd.DataFrame(index=df.index)
+    out["pmid"] = df["PMID"]
+    out["title"] = df["TI"]
+    out["journal"] = df["JT"].where(df["JT"] != "", df["TA"])
+    out["year"] = df["DP"].astype(str).str.extract(r"^(\d{4})", expand=False).fillna("")
+    out["abstract"] = df["AB"].map(lambda ab: " ".join(ab) if isinstance(ab, list) else ab)
 
-def build_context(record: Dict[str, Any]) -> str:
-    """
-    Concatenates title and abstract for NER input.
-    """
-    title = record.get("TI", "") or ""
-    abstract = join_abstract(record)
-    parts = []
-    if title.strip():
-        parts.append(title.strip())
-    if abstract.strip():
-        parts.append(abstract.strip())
-    return ". ".join(parts)
+    title = out["title"].str.strip()
+    abstract = out["abstract"].str.strip()
+    both = (title != "") & (abstract != "")
+    out["context"] = (title + ". " + abstract).where(both, title + abstract)
+    return out
 
 
 # -----------------------------------------------
-# Step 4. Load BioBERT NER as a HF pipeline
+# Step 4. Load BioBERT NER model and tokenizer
 # -----------------------------------------------
-def load_biobert_ner(model_name: str) -> TokenClassificationPipeline:
+class NerModel(NamedTuple):
+    """
+    Token classification model with its tokenizer, the device that
+    input batches must be moved to, the number of windows per forward
+    pass and whether the model was wrapped by torch.compile.
+    """
+    model: Any
+    tokenizer: Any
+    device: Any
+    batch_size: int = NER_BATCH
+    compiled: bool = False
+
+
+def load_biobert_ner(model_name: str, batch_size: int = NER_BATCH) -> NerModel:
     """
-    Loads tokenizer and model. Builds a token classification pipeline.
-    Uses GPU when available.
+    Loads tokenizer and model. Uses GPU when available, in FP16 unless
+    NER_FP16=0. batch_size is the number of windows per forward pass.
     """
     print(f"Loading NER model {model_name}")
     tok = AutoTokenizer.from_pretrained(model_name)
     mdl = AutoModelForTokenClassification.from_pretrained(model_name)
-    device = 0 if torch.cuda.is_available() else -1
-    return TokenClassificationPipeline(
-        model=mdl,
-        tokenizer=tok,
-        aggregation_strategy="simple",
-        device=device
-    )
+    use_gpu = torch.cuda.is_available()
+    if use_gpu:
+        # TF32 matmuls and cuDNN autotuning on Ampere and newer GPUs
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        if NER_FP16:
+            mdl = mdl.half()
+    device = torch.device("cuda" if use_gpu else "cpu")
+    ner = NerModel(model=mdl.to(device).eval(), tokenizer=tok, device=device, batch_size=batch_size)
+    if use_gpu and NER_COMPILE and hasattr(torch, "compile"):
+        ner = compile_ner_model(ner)
+    return ner
+
+
+def compile_ner_model(ner: NerModel) -> NerModel:
+    """
+    Returns a copy of ner with a torch.compile version of the model.
+    Runs one dummy batch of ner.batch_size rows per length in
+    LENGTH_BUCKETS, so every shape ner_chunks uses is compiled before
+    the first real batch.
+    """
+    print("Compiling NER model")
+    ner = ner._replace(model=torch.compile(ner.model, mode="reduce-overhead", fullgraph=False), compiled=True)
+    for size in LENGTH_BUCKETS:
+        dummy = ner.tokenizer(["warm up"] * ner.batch_size, padding="max_length",
+                              max_length=size, return_tensors="pt").to(ner.device)
+        with torch.inference_mode():
+            ner.model(**dummy)
+    return ner
+
+
+def load_biobert_ner_ort(model_name: str, batch_size: int = NER_BATCH) -> NerModel:
+    """
+    Exports the model to ONNX and serves it with ONNX Runtime.
+    Inputs go to the device of the chosen execution provider.
+    Needs optimum: pip install optimum[onnxruntime-gpu]
+    """
+    from optimum.onnxruntime import ORTModelForTokenClassification
+
+    provider = ORT_PROVIDER or ("CUDAExecutionProvider" if torch.cuda.is_available() else "CPUExecutionProvider")
+    print(f"Loading NER model {model_name} with ONNX Runtime ({provider})")
+    tok = AutoTokenizer.from_pretrained(model_name)
+    mdl = ORTModelForTokenClassification.from_pretrained(model_name, export=True, provider=provider)
+    return NerModel(model=mdl, tokenizer=tok, device=mdl.device, batch_size=batch_size)
 
 
 # -----------------------------------------------------
@@ -144,158 +318,403 @@ CANON_MAP = {
     "CHEMICALSUBSTANCE": "Drug"
 }
 
+def normalize_label(label: str) -> str:
+    """
+    Uppercases a label and drops hyphens and underscores.
+    """
+    return label.upper().replace("-", "").replace("_", "")
+
+# Exact lookups first, then substring rules with the longest keys first
+CANON_EXACT = {normalize_label(k): v for k, v in CANON_MAP.items()}
+CANON_SUBSTR = tuple(sorted(CANON_EXACT.items(), key=lambda kv: -len(kv[0])))
+
+@lru_cache(maxsize=512)
 def canonical_label(label: str) -> str:
     """
     Maps model label names to one of Disease, Gene, Drug, or Other.
     """
-    lab = label.upper().replace("-", "").replace("_", "")
-    for k, v in CANON_MAP.items():
-        if lab == k or k in lab:
+    lab = normalize_label(label)
+    exact = CANON_EXACT.get(lab)
+    if exact:
+        return exact
+    for k, v in CANON_SUBSTR:
+        if k in lab:
             return v
     return "Other"
 
-# Study design and clinical trial phase patterns
-STUDY_TYPE_PATTERNS = [
-    r"\brandomi[sz]ed controlled trial\b",
-    r"\bclinical trial\b",
-    r"\bmeta-analysis\b",
-    r"\bsystematic review\b",
-    r"\bcohort study\b",
-    r"\bcase[- ]control study\b",
-    r"\bcross[- ]sectional study\b",
-    r"\bprospective study\b",
-    r"\bretrospective study\b",
-    r"\bcase series\b",
-    r"\bcase report\b"
+# Study design and clinical trial phase keywords, with spelling variants
+STUDY_TYPE_TERMS = [
+    "randomized controlled trial",
+    "randomised controlled trial",
+    "clinical trial",
+    "meta-analysis",
+    "systematic review",
+    "cohort study",
+    "case-control study",
+    "case control study",
+    "cross-sectional study",
+    "cross sectional study",
+    "prospective study",
+    "retrospective study",
+    "case series",
+    "case report"
 ]
 
-TRIAL_PHASE_PATTERNS = [
-    r"\bphase I\b",
-    r"\bphase II\b",
-    r"\bphase III\b",
-    r"\bphase IV\b"
+TRIAL_PHASE_TERMS = [
+    "phase i",
+    "phase ii",
+    "phase iii",
+    "phase iv"
 ]
 
-def find_keywords(text: str, patterns) -> List[str]:
+def build_automaton(terms: List[str]) -> ahocorasick.Automaton:
+    """
+    Builds an Aho-Corasick automaton that reports each term as its value.
+    """
+    auto = ahocorasick.Automaton()
+    for t in terms:
+        auto.add_word(t, t)
+    auto.make_automaton()
+    return auto
+
+# One automaton per keyword list. Text is lowercased first
+STUDY_AUTO = build_automaton(STUDY_TYPE_TERMS)
+PHASE_AUTO = build_automaton(TRIAL_PHASE_TERMS)
+
+def is_word_char(c: str) -> bool:
     """
-    Returns matched study keywords. Case insensitive search.
+    True for characters that regex \\w treats as part of a word.
+    """
+    return c.isalnum() or c == "_"
+
+def find_keywords(text_lower: str, auto: ahocorasick.Automaton) -> List[str]:
+    """
+    Returns matched study keywords. Expects lowercased text.
+    Only whole word matches count, like a regex with \\b on both ends.
     """
     found = set()
-    low = text.lower()
-    for pat in patterns:
-        for m in re.finditer(pat, low, flags=re.IGNORECASE):
-            found.add(m.group(0))
+    for end, term in auto.iter(text_lower):
+        start = end - len(term) + 1
+        if start > 0 and is_word_char(text_lower[start - 1]):
+            continue
+        if end + 1 < len(text_lower) and is_word_char(text_lower[end + 1]):
+            continue
+        found.add(term)
     return sorted(found)
 
 
+def study_keywords(context: str) -> Tuple[List[str], List[str]]:
+    """
+    Returns the study types and trial phases mentioned in a text.
+    """
+    low = context.lower()
+    return find_keywords(low, STUDY_AUTO), find_keywords(low, PHASE_AUTO)
+
+
 # -------------------------------------------------
-# Step 6. NER over one long document with chunking
+# Step 6. NER over many long documents with chunking
 # -------------------------------------------------
-def ner_document(pipe: TokenClassificationPipeline, text: str, max_chars: int) -> Dict[str, List[str]]:
+def chunk_text(text: str, max_chars: int) -> List[str]:
     """
-    Applies NER to a long text using simple character chunking.
-    Aggregates and deduplicates entities.
+    Splits a long text into character chunks to avoid truncation.
+    Cuts at the last full stop inside each window when possible.
+    Full stops are located once and each cut is a binary search.
     """
-    if not text:
-        return {"Disease": [], "Gene": [], "Drug": []}
-
-    # Chunk by characters to avoid truncation
+    dots = [m.start() for m in re.finditer(r"\.", text)]
     chunks = []
     s = 0
     while s < len(text):
         e = min(s + max_chars, len(text))
-        cut = text.rfind(".", s, e)
-        if cut == -1 or cut <= s:
-            cut = e
+        k = bisect_left(dots, e) - 1
+        cut = dots[k] if k >= 0 and dots[k] > s else e
         chunks.append(text[s:cut])
         s = cut + 1
+    # Stripped so repeated sentences give identical chunks
+    return [ch.strip() for ch in chunks if ch.strip()]
+
 
-    buckets = defaultdict(list)
-    for ch in chunks:
-        if not ch.strip():
+def chunk_entities(outputs: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """
+    Maps the NER output of one chunk to Disease, Gene and Drug words.
+    """
+    disease, gene, drug = [], [], []
+    for r in outputs:
+        word = r.get("word", "").strip()
+        if not word:
             continue
-        outputs = pipe(ch)
-        for r in outputs:
-            word = r.get("word", "").strip()
-            label = r.get("entity_group", r.get("entity", ""))
-            group = canonical_label(label)
-            if group in {"Disease", "Gene", "Drug"} and word:
-                buckets[group].append(word)
-
-    # Deduplicate while preserving order
-    for k in list(buckets.keys()):
-        seen = set()
-        ordered = []
-        for w in buckets[k]:
-            wl = w.lower()
-            if wl in seen:
-                continue
-            seen.add(wl)
-            ordered.append(w)
-        buckets[k] = ordered
-
-    for k in ["Disease", "Gene", "Drug"]:
-        buckets.setdefault(k, [])
-
-    return buckets
+        group = canonical_label(r.get("entity_group", r.get("entity", "")))
+        if group == "Disease":
+            disease.append(word)
+        elif group == "Gene":
+            gene.append(word)
+        elif group == "Drug":
+            drug.append(word)
+    return {"Disease": disease, "Gene": gene, "Drug": drug}
+
+
+def dedupe_words(words: List[str]) -> List[str]:
+    """
+    Deduplicates words case insensitively. Keeps the first spelling and order.
+    """
+    seen = {}
+    for w in words:
+        seen.setdefault(w.lower(), w)
+    return list(seen.values())
+
+
+def collect_entities(chunk_buckets: List[Dict[str, List[str]]]) -> Dict[str, List[str]]:
+    """
+    Merges the entities of all chunks of one document.
+    Deduplicates them case insensitively while preserving order.
+    """
+    disease, gene, drug = [], [], []
+    for cb in chunk_buckets:
+        disease.extend(cb["Disease"])
+        gene.extend(cb["Gene"])
+        drug.extend(cb["Drug"])
+    return {"Disease": dedupe_words(disease), "Gene": dedupe_words(gene), "Drug": dedupe_words(drug)}
+
+
+def decode_entities(text: str, pred_ids: List[int], offsets: List[Any],
+                    id2label: Dict[int, str]) -> List[Dict[str, Any]]:
+    """
+    Groups the token predictions of one chunk into entity spans,
+    like the HF pipeline's aggregation_strategy="simple".
+    Words are cut from the original text using the token offsets.
+    """
+    spans = []
+    cur = None
+    for p, (a, b) in zip(pred_ids, offsets):
+        label = id2label[p]
+        if label == "O":
+            cur = None
+            continue
+        if label[:2] in ("B-", "I-"):
+            tag, group = label[0], label[2:]
+        else:
+            tag, group = "I", label
+        if cur is not None and tag == "I" and cur["entity_group"] == group:
+            cur["end"] = b
+        else:
+            cur = {"entity_group": group, "start": a, "end": b}
+            spans.append(cur)
+    return [{"entity_group": e["entity_group"], "word": text[e["start"]:e["end"]]} for e in spans]
+
+
+def ner_chunks(ner: NerModel, chunks: List[str]) -> List[List[Dict[str, Any]]]:
+    """
+    Runs the model directly on a list of chunks. Each chunk is tokenized
+    once into overlapping windows, windows of similar length are batched
+    together, and the window predictions are stitched back per chunk
+    before entity spans are decoded.
+    A compiled model gets batches padded to ner.batch_size rows and to a
+    length from LENGTH_BUCKETS.
+    Returns the entities of every chunk in HF pipeline output format.
+    """
+    tok, mdl = ner.tokenizer, ner.model
+    enc = tok(
+        chunks,
+        max_length=NER_MAX_TOKENS,
+        stride=NER_STRIDE,
+        truncation=True,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+        return_special_tokens_mask=True
+    )
+    model_keys = [k for k in ("input_ids", "attention_mask", "token_type_ids") if k in enc]
+    n = len(enc["input_ids"])
+    batch_size = ner.batch_size
+
+    # Shortest windows first so each batch needs little padding
+    order = sorted(range(n), key=lambda w: len(enc["input_ids"][w]))
+    preds = [None] * n
+    for b in range(0, n, batch_size):
+        ws = order[b:b + batch_size]
+        feats = [{k: enc[k][w] for k in model_keys} for w in ws]
+        if ner.compiled:
+            # Fixed batch size and bucketed length keep the compiled shapes few.
+            # Filler rows repeat the first window and their logits are ignored
+            feats += [feats[0]] * (batch_size - len(feats))
+            longest = len(enc["input_ids"][ws[-1]])
+            target = next(size for size in LENGTH_BUCKETS if size >= longest)
+            batch = tok.pad(feats, padding="max_length", max_length=target, return_tensors="pt")
+        else:
+            batch = tok.pad(feats, return_tensors="pt")
+        batch = batch.to(ner.device)
+        with torch.inference_mode():
+            logits = mdl(**batch).logits
+        for w, p in zip(ws, logits.argmax(dim=-1).tolist()):
+            preds[w] = p[:len(enc["input_ids"][w])]
+
+    # Stitch the windows of each chunk back into one token sequence.
+    # A token seen by two windows takes the prediction of the window where
+    # it sits further from the edge, so entities are never cut at a border
+    tokens = [{} for _ in chunks]
+    for w in range(n):
+        c = enc["overflow_to_sample_mapping"][w]
+        offsets = enc["offset_mapping"][w]
+        inner = [t for t, sp in enumerate(enc["special_tokens_mask"][w]) if not sp]
+        for pos, t in enumerate(inner):
+            edge = min(pos, len(inner) - 1 - pos)
+            start, end = offsets[t]
+            seen = tokens[c].get(start)
+            if seen is None or edge > seen[2]:
+                tokens[c][start] = (end, preds[w][t], edge)
+
+    id2label = mdl.config.id2label
+    outputs = []
+    for c, toks in enumerate(tokens):
+        starts = sorted(toks)
+        outputs.append(decode_entities(chunks[c], [toks[a][1] for a in starts],
+                                       [(a, toks[a][0]) for a in starts], id2label))
+    return outputs
+
+
+def open_ner_cache(path: str) -> sqlite3.Connection:
+    """
+    Opens the NER cache database. Creates the table on first use.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS ner (hash TEXT PRIMARY KEY, buckets_json TEXT)")
+    return conn
+
+
+def ner_cache_key(cache_tag: str, chunk: str) -> str:
+    """
+    Content hash of a chunk for the given model settings.
+    """
+    return hashlib.blake2b(f"{cache_tag}\n{chunk}".encode("utf8"), digest_size=16).hexdigest()
+
+
+def ner_documents(ner: NerModel, texts: List[str], max_chars: int,
+                  bucket: int = SORT_BUCKET, cache: Optional[sqlite3.Connection] = None,
+                  cache_tag: str = NER_CACHE_TAG) -> Iterator[Dict[str, List[str]]]:
+    """
+    Applies NER to many long texts. Chunks every text up front and
+    sends the chunks to the model a bucket at a time, so windows of
+    similar token length can be batched together.
+    Identical chunks run through the model once per run, and with a
+    cache, chunks seen in earlier runs skip the model.
+    Yields one entity dict per text, in input order, as soon as all
+    chunks of that text are done.
+    """
+    # (text index, chunk) for every chunk of every text
+    index = []
+    for i, text in enumerate(texts):
+        for ch in chunk_text(text or "", max_chars):
+            index.append((i, ch))
+
+    # Position of the last chunk of each text, -1 for texts without chunks
+    last = [-1] * len(texts)
+    for j, (i, _) in enumerate(index):
+        last[i] = j
+
+    # Entities per chunk hash. Repeated chunks run through the model once
+    memo = {}
+    per_text = [[] for _ in texts]
+    done = 0
+    for b in range(0, len(index), bucket):
+        ids = list(range(b, min(b + bucket, len(index))))
+        keys = {j: ner_cache_key(cache_tag, index[j][1]) for j in ids}
+
+        # Distinct chunks of this bucket not seen earlier in the run
+        todo = {}
+        for j in ids:
+            if keys[j] not in memo:
+                todo.setdefault(keys[j], index[j][1])
+
+        # Look them up in the cache first
+        if todo and cache is not None:
+            marks = ",".join("?" * len(todo))
+            cur = cache.execute(f"SELECT hash, buckets_json FROM ner WHERE hash IN ({marks})", list(todo))
+            for h, v in cur:
+                memo[h] = json.loads(v)
+                del todo[h]
+
+        if todo:
+            outs = ner_chunks(ner, list(todo.values()))
+            for h, out in zip(todo, outs):
+                memo[h] = chunk_entities(out)
+
+            if cache is not None:
+                cache.executemany("INSERT OR REPLACE INTO ner VALUES (?, ?)",
+                                  [(h, json.dumps(memo[h], ensure_ascii=False)) for h in todo])
+                cache.commit()
+
+        for j in ids:
+            per_text[index[j][0]].append(memo[keys[j]])
+
+        # Hand out every text whose chunks are all done
+        while done < len(texts) and last[done] <= ids[-1]:
+            yield collect_entities(per_text[done])
+            per_text[done] = []
+            done += 1
+
+    while done < len(texts):
+        yield collect_entities(per_text[done])
+        done += 1
 
 
 # ----------------------------------------------------------------
 # Step 7. Analyze all records. Extract entities and study signals
 # ----------------------------------------------------------------
-def analyze_records(pipe: TokenClassificationPipeline, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def analyze_records(ner: NerModel, records: List[Dict[str, Any]], out: TextIO,
+                    cache: Optional[sqlite3.Connection] = None) -> Iterator[Dict[str, Any]]:
     """
     Runs NER and keyword matching per MEDLINE record.
-    Collects metadata and returns a list of result dicts.
-    """
-    rows = []
-    for r in tqdm(records, desc="Analyzing records"):
-        pmid = r.get("PMID", "")
-        title = r.get("TI", "") or ""
-        journal = r.get("JT", "") or r.get("TA", "") or ""
-        year = ""
-        dp = r.get("DP", "")
-        if isinstance(dp, str):
-            m = re.match(r"(\d{4})", dp)
-            if m:
-                year = m.group(1)
-
-        context = build_context(r)
-        ents = ner_document(pipe, context, INFER_CHARS)
-        study_types = find_keywords(context, STUDY_TYPE_PATTERNS)
-        trial_phases = find_keywords(context, TRIAL_PHASE_PATTERNS)
-
-        rows.append({
-            "pmid": pmid,
-            "title": title,
-            "journal": journal,
-            "year": year,
-            "diseases": ents["Disease"],
-            "genes": ents["Gene"],
-            "drugs": ents["Drug"],
-            "study_types": study_types,
-            "trial_phases": trial_phases,
-            "abstract": join_abstract(r)
-        })
-    return rows
+    Writes each result dict to the open JSONL file as soon as it is
+    ready and yields it.
+    """
+    df = records_frame(records)
+    contexts = df["context"].tolist()
+
+    # Keyword search runs in a worker thread while the model runs NER
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        keywords = pool.map(study_keywords, contexts)
+        entities = ner_documents(ner, contexts, INFER_CHARS, cache=cache)
+
+        meta = zip(df["pmid"], df["title"], df["journal"], df["year"], df["abstract"])
+        for (pmid, title, journal, year, abstract), ents, (study_types, trial_phases) in tqdm(
+                zip(meta, entities, keywords), total=len(df), desc="Analyzing records"):
+            row = {
+                "pmid": pmid,
+                "title": title,
+                "journal": journal,
+                "year": year,
+                "diseases": ents["Disease"],
+                "genes": ents["Gene"],
+                "drugs": ents["Drug"],
+                "study_types": study_types,
+                "trial_phases": trial_phases,
+                "abstract": abstract
+            }
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            out.flush()
+            yield row
 
 
 # --------------------------------------------
-# Step 8. Save the results to JSONL and CSV
+# Step 8. Convert the JSONL results to CSV
 # --------------------------------------------
-def save_outputs(rows: List[Dict[str, Any]], out_dir: str) -> None:
+CSV_FIELDS = ["pmid", "title", "journal", "year", "diseases", "genes", "drugs",
+              "study_types", "trial_phases", "abstract"]
+
+def save_outputs(jsonl_path: str, out_dir: str) -> None:
     """
-    Persists results to a JSONL file and a CSV table.
+    Reads the JSONL results back line by line and writes a CSV table.
+    List columns are joined with "; ".
     """
-    jsonl_path = os.path.join(out_dir, "pubmed_ocular_biobert.jsonl")
     csv_path = os.path.join(out_dir, "pubmed_ocular_biobert.csv")
 
-    with open(jsonl_path, "w", encoding="utf8") as f:
-        for row in rows:
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
-
-    pd.DataFrame(rows).to_csv(csv_path, index=False)
-    print(f"Wrote {len(rows)} rows")
+    n = 0
+    with open(jsonl_path, encoding="utf8") as src, open(csv_path, "w", encoding="utf8", newline="") as dst:
+        writer = csv.DictWriter(dst, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for line in src:
+            row = json.loads(line)
+            writer.writerow({k: "; ".join(v) if isinstance(v, list) else v for k, v in row.items()})
+            n += 1
+    print(f"Wrote {n} rows")
     print(f"JSONL  {jsonl_path}")
     print(f"CSV    {csv_path}")
 
@@ -304,6 +723,8 @@ def save_outputs(rows: List[Dict[str, Any]], out_dir: str) -> None:
 # Step 9. Glue it together in main function
 # --------------------------------------------
 def main():
+    os.makedirs(OUT_DIR, exist_ok=True)
+
     # Search PubMed for PMIDs
     print("Step 1. Search PubMed")
     pmids = search_pmids(PUBMED_QUERY, RETMAX)
@@ -319,15 +740,24 @@ def main():
 
     # Load BioBERT NER
     print("Step 3. Load BioBERT NER")
-    pipe = load_biobert_ner(NER_MODEL)
+    if NER_BACKEND == "onnx":
+        ner = load_biobert_ner_ort(NER_MODEL)
+    else:
+        ner = load_biobert_ner(NER_MODEL)
 
     # Run extraction
+    # Results are streamed to JSONL one record at a time
     print("Step 4. Extract entities and study info")
-    rows = analyze_records(pipe, records)
+    jsonl_path = os.path.join(OUT_DIR, "pubmed_ocular_biobert.jsonl")
+    cache = open_ner_cache(NER_CACHE_PATH)
+    with open(jsonl_path, "w", encoding="utf8") as f:
+        for _ in analyze_records(ner, records, f, cache):
+            pass
+    cache.close()
 
     # Save outputs
     print("Step 5. Save outputs")
-    save_outputs(rows, OUT_DIR)
+    save_outputs(jsonl_path, OUT_DIR)
 
     print("Done")
 
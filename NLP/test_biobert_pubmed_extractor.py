@@ -0,0 +1,144 @@
+import io
+
+from Bio import Medline
+
+from biobert_pubmed_extractor import MEDLINE_KEYS, parse_medline_minimal
+
+
+# Abstract with a blank continuation line between paragraphs
+MEDLINE_TEXT = (
+    "PMID- 111\n"
+    "TI  - A title.\n"
+    "AB  - First paragraph.\n"
+    "      \n"
+    "      Second paragraph.\n"
+    "JT  - Journal of Eyes\n"
+    "TA  - J Eyes\n"
+    "DP  - 2021 May\n"
+)
+
+
+def test_blank_continuation_line_does_not_end_record():
+    recs = list(parse_medline_minimal(io.StringIO(MEDLINE_TEXT)))
+    assert len(recs) == 1
+    assert recs[0]["PMID"] == "111"
+    assert recs[0]["DP"] == "2021 May"
+    assert recs[0]["AB"].startswith("First paragraph.")
+    assert recs[0]["AB"].endswith("Second paragraph.")
+
+
+def test_matches_biopython_on_used_fields():
+    text = MEDLINE_TEXT + "\n" + MEDLINE_TEXT.replace("111", "222")
+    expected = [{k: v for k, v in r.items() if k in MEDLINE_KEYS} for r in Medline.parse(io.StringIO(text))]
+    assert list(parse_medline_minimal(io.StringIO(text))) == expected
+
+
+# -------------------------------------------------------------
+# NER decoding over overlapping token windows
+# -------------------------------------------------------------
+import string
+from types import SimpleNamespace
+
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast
+
+import biobert_pubmed_extractor as bx
+
+
+ID2LABEL = {0: "O", 1: "B-Disease", 2: "I-Disease"}
+
+
+def letter_tokenizer() -> PreTrainedTokenizerFast:
+    """
+    WordPiece tokenizer with one token per letter, so words span many
+    tokens and entities easily cross window borders.
+    """
+    specials = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "."]
+    letters = list(string.ascii_lowercase)
+    vocab = {t: i for i, t in enumerate(specials + letters + ["##" + c for c in letters])}
+    core = Tokenizer(models.WordPiece(vocab, unk_token="[UNK]"))
+    core.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    core.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        special_tokens=[("[CLS]", vocab["[CLS]"]), ("[SEP]", vocab["[SEP]"])]
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=core, pad_token="[PAD]", unk_token="[UNK]",
+                                   cls_token="[CLS]", sep_token="[SEP]", model_max_length=512)
+
+
+class LetterModel(torch.nn.Module):
+    """
+    Labels each token from its id alone: a word starting with x is B-Disease,
+    the letters x, y, z anywhere else are I-Disease, everything else is O.
+    """
+    def __init__(self, tok: PreTrainedTokenizerFast):
+        super().__init__()
+        self.config = SimpleNamespace(id2label=ID2LABEL)
+        table = torch.zeros(len(tok), len(ID2LABEL))
+        table[:, 0] = 1
+        for token, i in tok.get_vocab().items():
+            if token == "x":
+                table[i] = torch.tensor([0.0, 1.0, 0.0])
+            elif token.lstrip("#") in ("x", "y", "z"):
+                table[i] = torch.tensor([0.0, 0.0, 1.0])
+        self.register_buffer("table", table)
+
+    def forward(self, input_ids, **kwargs):
+        return SimpleNamespace(logits=self.table[input_ids])
+
+
+TEXT = "abc xyzzyzzyzzy def yz ghi xaz xyzzy. xyzyzyzyzyzyzyzyzyzy end"
+
+
+@pytest.fixture
+def letter_ner():
+    tok = letter_tokenizer()
+    return bx.NerModel(model=LetterModel(tok), tokenizer=tok, device=torch.device("cpu"))
+
+
+def test_decode_entities_groups_b_i_and_resets_on_o():
+    text = "aa bb cc dd ee ff"
+    offsets = [(0, 2), (3, 5), (6, 8), (9, 11), (12, 14), (15, 17)]
+    # B I | O | I (starts new) | B | B (starts new)
+    preds = [1, 2, 0, 2, 1, 1]
+    ents = bx.decode_entities(text, preds, offsets, ID2LABEL)
+    assert [e["word"] for e in ents] == ["aa bb", "dd", "ee", "ff"]
+    assert all(e["entity_group"] == "Disease" for e in ents)
+
+
+def test_letter_model_single_window(letter_ner):
+    words = [e["word"] for e in bx.ner_chunks(letter_ner, [TEXT])[0]]
+    assert words == ["xyzzyzzyzzy", "yz", "x", "z", "xyzzy", "xyzyzyzyzyzyzyzyzyzy"]
+
+
+@pytest.mark.parametrize("max_tokens,stride", [(6, 1), (8, 2), (10, 4), (12, 3), (16, 7)])
+def test_windows_match_single_pass(letter_ner, monkeypatch, max_tokens, stride):
+    whole = bx.ner_chunks(letter_ner, [TEXT, "short xy"])
+
+    monkeypatch.setattr(bx, "NER_MAX_TOKENS", max_tokens)
+    monkeypatch.setattr(bx, "NER_STRIDE", stride)
+    windowed = bx.ner_chunks(letter_ner._replace(batch_size=3), [TEXT, "short xy"])
+
+    assert windowed == whole
+
+
+def test_compiled_batches_have_fixed_shapes(letter_ner, monkeypatch):
+    whole = bx.ner_chunks(letter_ner, [TEXT, "short xy"])
+
+    monkeypatch.setattr(bx, "NER_MAX_TOKENS", 10)
+    monkeypatch.setattr(bx, "NER_STRIDE", 3)
+    monkeypatch.setattr(bx, "LENGTH_BUCKETS", [8, 10])
+    shapes = []
+    forward = letter_ner.model.forward
+
+    def record(input_ids, **kwargs):
+        shapes.append(tuple(input_ids.shape))
+        return forward(input_ids, **kwargs)
+
+    monkeypatch.setattr(letter_ner.model, "forward", record)
+    ner = letter_ner._replace(batch_size=4, compiled=True)
+
+    assert bx.ner_chunks(ner, [TEXT, "short xy"]) == whole
+    assert shapes and set(shapes) <= {(4, 8), (4, 10)}